@@ -1,5 +1,6 @@
 from __future__ import annotations
 import torch
+from transformers import BlipForConditionalGeneration
 
 
 def pick_device() -> tuple[str, torch.dtype]:
@@ -10,4 +11,17 @@ def pick_device() -> tuple[str, torch.dtype]:
     return "cpu", torch.float32
 
 
+def load_blip_model(model_name: str, **kwargs) -> BlipForConditionalGeneration:
+    """Load BLIP with SDPA attention when this transformers version supports it for BLIP."""
+    try:
+        return BlipForConditionalGeneration.from_pretrained(
+            model_name, attn_implementation="sdpa", use_safetensors=True, **kwargs
+        )
+    except ValueError as e:
+        # only retry when SDPA itself is unsupported; other load errors propagate
+        if "sdpa" not in str(e) and "scaled_dot_product_attention" not in str(e):
+            raise
+        return BlipForConditionalGeneration.from_pretrained(model_name, use_safetensors=True, **kwargs)
+
+
 DEFAULT_MODEL_NAME = "Salesforce/blip-image-captioning-base"
\ No newline at end of file
@@ -1,52 +1,123 @@
 from __future__ import annotations
 
-import json
-from dataclasses import dataclass
+import hashlib
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
+import orjson
+import torch
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 
 def load_jsonl(path: str | Path) -> List[Dict[str, Any]]:
-    path = Path(path)
-    rows = []
-    with path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            rows.append(json.loads(line))
-    return rows
+    with Path(path).open("rb") as f:
+        return [orjson.loads(line) for line in f if line.strip()]
 
 
-@dataclass
-class Sample:
-    image_path: str
-    text: str
+class ProductCaptionDataset(Dataset):
+    def __init__(self, jsonl_path: str | Path, memmap_path: str | Path | None = None):
+        # parse and keep only valid rows in one pass, without an intermediate dict list;
+        # stored column-wise so workers get two flat str lists instead of N objects
+        self.image_paths: List[str] = []
+        self.texts: List[str] = []
+        with Path(jsonl_path).open("rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                r = orjson.loads(line)
+                ip = r.get("image_path")
+                txt = r.get("text")
+                if not ip or not txt:
+                    continue
+                self.image_paths.append(str(ip))
+                self.texts.append(str(txt))
 
+        # optional pre-resized uint8 images written by `python -m src.pack_dataset`
+        self.memmap_path = str(memmap_path) if memmap_path else None
+        self.memmap_shape: Optional[Tuple[int, ...]] = None
+        self._images: Optional[np.memmap] = None
+        if self.memmap_path:
+            meta = load_memmap_meta(self.memmap_path)
+            self.memmap_shape = tuple(meta["shape"])
+            if self.memmap_shape[0] != len(self.texts):
+                raise ValueError(
+                    f"{self.memmap_path} holds {self.memmap_shape[0]} images but {jsonl_path} has {len(self.texts)} rows"
+                )
+            # same count isn't enough: images must be in the same order as these captions
+            if meta.get("image_paths_hash") != hash_image_paths(self.image_paths):
+                raise ValueError(
+                    f"{self.memmap_path} was packed from different images than {jsonl_path} "
+                    f"(packed from {meta.get('jsonl')}); re-run src.pack_dataset"
+                )
+
+    def __len__(self) -> int:
+        return len(self.image_paths)
+
+    def __getitem__(self, idx: int) -> Tuple[Union[str, np.ndarray], str]:
+        if self.memmap_path is None:
+            return self.image_paths[idx], self.texts[idx]
+        if self._images is None:
+            # opened lazily so each DataLoader worker maps the file itself instead of
+            # receiving a pickled copy of the array
+            self._images = np.memmap(self.memmap_path, dtype=np.uint8, mode="r", shape=self.memmap_shape)
+        return self._images[idx], self.texts[idx]
 
-class ProductCaptionDataset(Dataset):
-    def __init__(self, jsonl_path: str | Path):
-        self.rows = load_jsonl(jsonl_path)
-
-        # keep only valid rows
-        clean = []
-        for r in self.rows:
-            ip = r.get("image_path")
-            txt = r.get("text")
-            if not ip or not txt:
-                continue
-            clean.append(Sample(image_path=str(ip), text=str(txt)))
-        self.rows = clean
+
+class SortedBatchSampler(Sampler[List[int]]):
+    """Batches samples of similar caption length to cut padding.
+
+    Indices are shuffled, split into mega-batches of ``batch_size * mega_factor``,
+    sorted by text length (a cheap stand-in for token count) inside each, then cut
+    into batches whose order is shuffled again.
+    """
+
+    def __init__(self, dataset: ProductCaptionDataset, batch_size: int, mega_factor: int = 50):
+        self.lengths = [len(t) for t in dataset.texts]
+        self.batch_size = batch_size
+        self.mega_size = batch_size * mega_factor
 
     def __len__(self) -> int:
-        return len(self.rows)
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = torch.randperm(len(self.lengths)).tolist()
+        batches = []
+        for start in range(0, len(order), self.mega_size):
+            mega = sorted(order[start:start + self.mega_size], key=self.lengths.__getitem__)
+            batches.extend(mega[i:i + self.batch_size] for i in range(0, len(mega), self.batch_size))
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
 
-    def __getitem__(self, idx: int) -> Sample:
-        return self.rows[idx]
+
+def hash_image_paths(image_paths: List[str]) -> str:
+    h = hashlib.sha256()
+    for p in image_paths:
+        h.update(p.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_memmap_meta(memmap_path: str | Path) -> Dict[str, Any]:
+    with Path(f"{memmap_path}.json").open("rb") as f:
+        return orjson.loads(f.read())
+
+
+# BLIP's processor resizes to 384x384, so there's no point decoding JPEGs at full size
+DRAFT_SIZE = (384, 384)
 
 
 def load_image_rgb(path: str) -> Image.Image:
-    return Image.open(path).convert("RGB")
\ No newline at end of file
+    img = Image.open(path)
+    img.draft("RGB", DRAFT_SIZE)
+    return img.convert("RGB")
+
+
+def load_image_resized(path: str, size: Tuple[int, int], resample: int) -> np.ndarray:
+    """Decode and PIL-resize to ``size`` (width, height); uint8 HWC.
+
+    The single resize used for training, both when packing the memmap and when
+    the collator decodes on the fly, so both paths produce identical pixels.
+    """
+    return np.asarray(load_image_rgb(path).resize(size, resample=resample))
\ No newline at end of file
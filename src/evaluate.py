@@ -6,25 +6,36 @@ from pathlib import Path
 from typing import Any, Dict, Iterable, List, Tuple
 
 import evaluate
+import orjson
 
 
 def iter_jsonl(path: Path) -> Iterable[Dict[str, Any]]:
-    with path.open("r", encoding="utf-8") as f:
+    with path.open("rb") as f:
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
-            yield json.loads(line)
+            yield orjson.loads(line)
+
+
+# loaded once per process; evaluate.load() re-resolves the metric scripts every call
+_BLEU = None
+_ROUGE = None
 
 
 def compute_metrics(preds: List[str], refs: List[str]) -> Dict[str, Any]:
+    global _BLEU, _ROUGE
+    # `is None`, not `or`: EvaluationModule.__len__ is the buffered example count,
+    # which is 0 after compute(), so a loaded module is falsy
+    if _BLEU is None:
+        _BLEU = evaluate.load("sacrebleu")
+    if _ROUGE is None:
+        _ROUGE = evaluate.load("rouge")
+
     # BLEU
-    bleu = evaluate.load("sacrebleu")
-    bleu_res = bleu.compute(predictions=preds, references=[[r] for r in refs])
+    bleu_res = _BLEU.compute(predictions=preds, references=[[r] for r in refs])
 
     # ROUGE (rouge1/rouge2/rougeL/rougeLsum)
-    rouge = evaluate.load("rouge")
-    rouge_res = rouge.compute(predictions=preds, references=refs)
+    rouge_res = _ROUGE.compute(predictions=preds, references=refs)
 
     return {
         "sacrebleu": float(bleu_res["score"]),
@@ -44,14 +55,10 @@ def save_json(path: Path, obj: Dict[str, Any]) -> None:
 
 def save_samples_md(path: Path, rows: List[Tuple[str, str, str]], limit: int = 50) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    lines = ["# Samples (reference vs prediction)\n"]
-    for i, (img, ref, pred) in enumerate(rows[:limit], start=1):
-        lines.append(f"## {i}\n")
-        lines.append(f"- image_path: `{img}`\n")
-        lines.append(f"- reference: {ref}\n")
-        lines.append(f"- prediction: {pred}\n")
-        lines.append("\n")
-    path.write_text("".join(lines), encoding="utf-8")
+    with path.open("w", encoding="utf-8") as f:
+        f.write("# Samples (reference vs prediction)\n")
+        for i, (img, ref, pred) in enumerate(rows[:limit], start=1):
+            f.write(f"## {i}\n- image_path: `{img}`\n- reference: {ref}\n- prediction: {pred}\n\n")
 
 
 def main():
@@ -1,25 +1,146 @@
 from __future__ import annotations
 
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
 import torch
 from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
+from transformers import BitsAndBytesConfig, BlipProcessor
 
-from .config import pick_device
+from .config import load_blip_model, pick_device
+from .dataset import load_image_rgb
 
 from peft import PeftModel
 
+
+# left unquantized under int8 (CUDA and CPU): the LM head is sensitive to 8-bit weights
+_INT8_SKIP_MODULES = ["cls"]
+
+# traced CPU vision encoders are cached here to skip re-tracing on later launches
+_TS_CACHE_DIR = Path.home() / ".cache" / "blip_captioner_ts"
+
+
 class BlipCaptioner:
-    def __init__(self, model_name: str, adapter_path: str | None = None):
+    def __init__(
+        self,
+        model_name: str,
+        adapter_path: str | None = None,
+        quantize: str | None = None,
+        inference_merge: bool = True,
+        max_new_tokens_cap: int = 40,
+        max_batch_size: int = 1,
+    ):
         self.model_name = model_name
         self.device, self.amp_dtype = pick_device()
+        if quantize not in (None, "int8"):
+            raise ValueError(f"Unsupported quantize mode: {quantize}")
+        if quantize == "int8" and self.device not in {"cuda", "cpu"}:
+            raise ValueError(f"int8 quantization is not supported on {self.device}")
+        self.quantize = quantize
 
         self.processor = BlipProcessor.from_pretrained(model_name)
-        self.model = BlipForConditionalGeneration.from_pretrained(model_name, use_safetensors=True)
+        # shared by every caption_batch() call for image decoding
+        self._pool = ThreadPoolExecutor(max_workers=8)
+        if quantize == "int8" and self.device == "cuda":
+            self.model = load_blip_model(
+                model_name,
+                quantization_config=BitsAndBytesConfig(
+                    load_in_8bit=True,
+                    llm_int8_skip_modules=_INT8_SKIP_MODULES,
+                ),
+                torch_dtype=torch.float16,
+                device_map="auto",
+            )
+        else:
+            self.model = load_blip_model(model_name)
         if adapter_path:
             self.model = PeftModel.from_pretrained(self.model, adapter_path)
-        self.model.to(self.device)
+            if inference_merge:
+                # fold LoRA deltas into the base weights: no extra matmuls at inference
+                self.model = self.model.merge_and_unload()
+        # fingerprint the float weights before quantization rewrites them; the
+        # traced-encoder cache is keyed on it
+        vision_fingerprint = self._vision_fingerprint() if self.device == "cpu" else None
+        if quantize == "int8" and self.device == "cpu":
+            # bitsandbytes is CUDA-only; use dynamic int8 Linear layers on CPU,
+            # skipping the same modules as the CUDA path
+            int8_linears = {
+                name
+                for name, module in self.model.named_modules()
+                if isinstance(module, torch.nn.Linear)
+                and not any(skip in name.split(".") for skip in _INT8_SKIP_MODULES)
+            }
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, int8_linears, dtype=torch.qint8)
+        if quantize != "int8" or self.device != "cuda":
+            # 8-bit models are already dispatched by device_map
+            self.model.to(self.device)
         self.model.eval()
 
+        if self.device == "cuda" and not quantize:
+            # Only the vision encoder is compiled: its inputs are always 384x384
+            # images. The text decoder runs with a growing KV cache, which
+            # would recompile at every decode step and break CUDA-graph replay.
+            vision_model = self.model.vision_model
+            vision_model.forward = torch.compile(vision_model.forward, mode="reduce-overhead", fullgraph=False)
+        elif self.device == "cpu":
+            self._trace_vision_model(vision_fingerprint)
+
+        if self.device == "cuda":
+            # pays the compile cost up-front and reserves the largest generate()
+            # buffers so later, shorter calls reuse them
+            self._warmup(max_new_tokens_cap, max_batch_size)
+
+    def _warmup(self, max_new_tokens: int, batch_size: int) -> None:
+        images = [Image.new("RGB", (384, 384))] * batch_size
+        # beam search needs more scratch than greedy, so this covers both;
+        # min_new_tokens forces the full length instead of stopping at EOS
+        self._generate(images, max_new_tokens=max_new_tokens, num_beams=3, min_new_tokens=max_new_tokens)
+
+    def _base_model(self):
+        return self.model.get_base_model() if isinstance(self.model, PeftModel) else self.model
+
+    @torch.no_grad()
+    def _vision_fingerprint(self) -> str:
+        # hashes the actual weights, so retrained local checkpoints and adapters
+        # that touch the vision tower never reuse a stale traced encoder
+        h = hashlib.blake2b(digest_size=16)
+        for name, t in self._base_model().vision_model.state_dict().items():
+            h.update(name.encode())
+            h.update(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        return h.hexdigest()
+
+    @torch.no_grad()
+    def _trace_vision_model(self, fingerprint: str) -> None:
+        # Only the vision encoder is traced: the text decoder's generate() loop has
+        # data-dependent control flow and a Python-side KV cache, so it stays eager.
+        base = self._base_model()
+        vision_model = base.vision_model
+        vision_model.config.torchscript = True  # return tuples, which tracing requires
+
+        cache_path = _TS_CACHE_DIR / f"{fingerprint}-{self.quantize or 'fp32'}-torch{torch.__version__}.pt"
+        if cache_path.exists():
+            traced = torch.jit.load(str(cache_path))
+        else:
+            size = self.processor.image_processor.size
+            example = torch.randn(1, 3, size["height"], size["width"])
+            traced = torch.jit.freeze(torch.jit.trace(vision_model, example))
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # write then rename, so a concurrent launch never loads a half-written file
+            fd, tmp = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+            os.close(fd)
+            try:
+                torch.jit.save(traced, tmp)
+                os.replace(tmp, cache_path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        base.vision_model = torch.jit.optimize_for_inference(traced)
+
     @torch.no_grad()
     def caption(
         self,
@@ -27,23 +148,77 @@ class BlipCaptioner:
         max_new_tokens: int = 40,
         num_beams: int = 3,
     ) -> str:
-        image = Image.open(image_path).convert("RGB")
-        inputs = self.processor(images=image, return_tensors="pt")
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        return self.caption_batch(
+            [image_path],
+            max_new_tokens=max_new_tokens,
+            num_beams=num_beams,
+            batch_size=1,
+        )[0]
+
+    @torch.no_grad()
+    def caption_batch(
+        self,
+        image_paths: List[str],
+        max_new_tokens: int = 40,
+        num_beams: int = 3,
+        batch_size: int = 16,
+    ) -> List[str]:
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be >= 1, got {batch_size}")
+        captions: List[str] = []
+        for start in range(0, len(image_paths), batch_size):
+            chunk = image_paths[start:start + batch_size]
+            images = list(self._pool.map(load_image_rgb, chunk))
+            captions.extend(self._generate(images, max_new_tokens, num_beams))
+
+        return captions
+
+    @torch.no_grad()
+    def _generate(self, images: List[Image.Image], max_new_tokens: int, num_beams: int, **generate_kwargs) -> List[str]:
+        inputs = self.processor(images=images, return_tensors="pt")
+        inputs = {k: v.to(self.device, non_blocking=True) for k, v in inputs.items()}
 
         use_amp = self.device in {"cuda", "mps"} and self.amp_dtype == torch.float16
         if use_amp:
             with torch.autocast(device_type=self.device, dtype=self.amp_dtype):
-                out = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_new_tokens,
-                    num_beams=num_beams,
-                )
+                out = self._decode(inputs["pixel_values"], max_new_tokens, num_beams, **generate_kwargs)
         else:
-            out = self.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                num_beams=num_beams,
-            )
+            out = self._decode(inputs["pixel_values"], max_new_tokens, num_beams, **generate_kwargs)
+
+        return [t.strip() for t in self.processor.batch_decode(out, skip_special_tokens=True)]
+
+    def _decode(self, pixel_values: torch.Tensor, max_new_tokens: int, num_beams: int, **generate_kwargs) -> torch.Tensor:
+        # Mirrors BlipForConditionalGeneration.generate(), which already runs the
+        # vision encoder once. It is spelled out only so that the encoder is called
+        # positionally, which the TorchScript-traced encoder on CPU requires (HF passes
+        # keyword arguments such as interpolate_pos_encoding). The processor always
+        # resizes to the model's native size, so no position interpolation is needed.
+        image_embeds = self.model.vision_model(pixel_values)[0]
+        image_attention_mask = torch.ones(image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device)
+
+        text_cfg = self.model.config.text_config
+        input_ids = torch.full(
+            (image_embeds.shape[0], 1),
+            text_cfg.bos_token_id,
+            dtype=torch.long,
+            device=image_embeds.device,
+        )
+        return self.model.text_decoder.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_attention_mask,
+            eos_token_id=text_cfg.sep_token_id,
+            pad_token_id=text_cfg.pad_token_id,
+            max_new_tokens=max_new_tokens,
+            **self._search_kwargs(num_beams),
+            **generate_kwargs,
+        )
 
-        return self.processor.decode(out[0], skip_special_tokens=True).strip()
\ No newline at end of file
+    @staticmethod
+    def _search_kwargs(num_beams: int) -> dict:
+        if num_beams == 1:
+            # greedy fast path: no beam bookkeeping, KV cache on
+            return {"num_beams": 1, "do_sample": False, "use_cache": True}
+        # stop as soon as every beam has emitted EOS
+        return {"num_beams": num_beams, "early_stopping": True}
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import orjson
+from tqdm import tqdm
+from transformers import BlipProcessor
+
+from .config import DEFAULT_MODEL_NAME
+from .dataset import ProductCaptionDataset, hash_image_paths, load_image_resized
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Resize dataset images once and store them as a uint8 NHWC memmap for training"
+    )
+    parser.add_argument("--jsonl", default="data/train.jsonl")
+    parser.add_argument("--out", default="data/train_imgs.bin")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    args = parser.parse_args()
+
+    processor = BlipProcessor.from_pretrained(args.model)
+    size = processor.image_processor.size
+    # same row filtering as training, so memmap index i matches dataset index i
+    ds = ProductCaptionDataset(args.jsonl)
+    shape = (len(ds), size["height"], size["width"], 3)
+    image_size = (size["width"], size["height"])
+
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    images = np.memmap(out_path, dtype=np.uint8, mode="w+", shape=shape)
+
+    for i, image_path in enumerate(tqdm(ds.image_paths)):
+        # resize only; rescale/normalize happen on the GPU in the training loop
+        images[i] = load_image_resized(image_path, image_size, processor.image_processor.resample)
+
+    images.flush()
+    with Path(f"{out_path}.json").open("wb") as f:
+        meta = {
+            "shape": list(shape),
+            "jsonl": str(args.jsonl),
+            "image_paths_hash": hash_image_paths(ds.image_paths),
+        }
+        f.write(orjson.dumps(meta))
+    print(f"Packed {len(ds)} images to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
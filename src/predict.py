@@ -1,28 +1,50 @@
 from __future__ import annotations
 
 import argparse
-import json
+import os
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, Optional, Set
+
+import orjson
 
 from .config import DEFAULT_MODEL_NAME
 from .model_wrapper import BlipCaptioner
 
 
 def iter_jsonl(path: Path) -> Iterable[Dict[str, Any]]:
-    with path.open("r", encoding="utf-8") as f:
+    with path.open("rb") as f:
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
-            yield json.loads(line)
+            yield orjson.loads(line)
 
 
 def write_jsonl(path: Path, rows: Iterable[Dict[str, Any]]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
+    with path.open("wb") as f:
         for r in rows:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            f.write(orjson.dumps(r) + b"\n")
+
+
+def image_exists(img_path: Path, listings: Dict[str, Set[str]]) -> bool:
+    """Check against a cached listing of the image's folder: one listdir() per folder
+    instead of a stat() per row. Listings are built lazily, so --limit stays cheap."""
+    d = str(img_path.parent)
+    if d not in listings:
+        try:
+            listings[d] = set(os.listdir(d))
+        except OSError:
+            listings[d] = set()
+    # names compare case-sensitively; on a miss fall back to stat() so that
+    # case-insensitive filesystems (macOS, Windows) still find e.g. IMG.JPG
+    return img_path.name in listings[d] or img_path.exists()
+
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {n}")
+    return n
 
 
 def main():
@@ -34,7 +56,8 @@ def main():
 
     parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="HF model name")
     parser.add_argument("--max_new_tokens", type=int, default=40)
-    parser.add_argument("--num_beams", type=int, default=3)
+    parser.add_argument("--num_beams", type=int, default=1, help="1 = greedy decoding (fastest)")
+    parser.add_argument("--batch_size", type=positive_int, default=16, help="Images per generate() call for --jsonl")
 
     parser.add_argument("--limit", type=int, default=0, help="Limit number of samples for --jsonl (0 = all)")
     parser.add_argument(
@@ -43,10 +66,22 @@ def main():
         help="Where to save predictions (only for --jsonl mode)",
     )
     parser.add_argument("--adapter", default=None, help="Path to LoRA adapter dir (outputs/lora_adapter)")
+    parser.add_argument("--quantize", choices=["int8"], default=None, help="Load the model with int8 weights")
 
     args = parser.parse_args()
 
-    captioner = BlipCaptioner(args.model, adapter_path=args.adapter)
+    # Growable segments keep repeated generate() calls with varying output lengths
+    # from fragmenting the caching allocator. Set here, by the entry point, before
+    # CUDA initializes, so other importers of BlipCaptioner (e.g. training) keep theirs.
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
+    captioner = BlipCaptioner(
+        args.model,
+        adapter_path=args.adapter,
+        quantize=args.quantize,
+        max_new_tokens_cap=args.max_new_tokens,
+        max_batch_size=1 if args.image else args.batch_size,
+    )
     
     # Single image mode
     if args.image:
@@ -68,6 +103,22 @@ def main():
 
     out_path = Path(args.out)
     preds = []
+    pending = []  # (index into preds, image path) waiting for a caption
+
+    def flush():
+        if not pending:
+            return
+        texts = captioner.caption_batch(
+            [p for _, p in pending],
+            max_new_tokens=args.max_new_tokens,
+            num_beams=args.num_beams,
+            batch_size=args.batch_size,
+        )
+        for (i, _), text in zip(pending, texts):
+            preds[i]["pred_text"] = text
+        pending.clear()
+
+    listings: Dict[str, Set[str]] = {}
 
     n = 0
     for row in iter_jsonl(in_path):
@@ -75,22 +126,21 @@ def main():
         if not image_path:
             continue
         img_path = Path(image_path)
-        if not img_path.exists():
+        if not image_exists(img_path, listings):
             # сохраняем факт пропуска, чтобы отлаживать датасет
             preds.append({**row, "pred_text": None, "error": "image_not_found"})
             continue
 
-        pred = captioner.caption(
-            image_path=str(img_path),
-            max_new_tokens=args.max_new_tokens,
-            num_beams=args.num_beams,
-        )
-        preds.append({**row, "pred_text": pred, "error": None})
+        pending.append((len(preds), str(img_path)))
+        preds.append({**row, "pred_text": None, "error": None})
+        if len(pending) >= args.batch_size:
+            flush()
 
         n += 1
         if args.limit and n >= args.limit:
             break
 
+    flush()
     write_jsonl(out_path, preds)
     print(f"Saved {len(preds)} predictions to {out_path}")
 
@@ -1,31 +1,102 @@
 from __future__ import annotations
 
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import bitsandbytes as bnb
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
-from transformers import BlipProcessor, BlipForConditionalGeneration, get_cosine_schedule_with_warmup
+from transformers import BlipProcessor, get_cosine_schedule_with_warmup
 from peft import LoraConfig, get_peft_model
 
-from .config import DEFAULT_MODEL_NAME, pick_device
-from .dataset import ProductCaptionDataset, load_image_rgb
+from .config import DEFAULT_MODEL_NAME, load_blip_model, pick_device
+from .dataset import ProductCaptionDataset, SortedBatchSampler, load_image_resized, load_image_rgb
 
 class BlipCollator:
-    def __init__(self, processor: BlipProcessor):
-        self.processor = processor
+    """Tokenizes captions and stacks images as uint8 NHWC; normalization happens on the GPU."""
+
+    def __init__(self, processor: BlipProcessor, decode_threads: int = 4):
+        # fast (Rust) tokenizer only: the processor's CPU rescale/normalize is skipped
+        self.tokenizer = processor.tokenizer
+        size = processor.image_processor.size
+        self.image_size = (size["width"], size["height"])
+        self.resample = processor.image_processor.resample
+        # kept small: this already runs inside each DataLoader worker
+        self.decode_threads = decode_threads
+        self._pool: ThreadPoolExecutor | None = None
+
+    def __getstate__(self):
+        # thread pools can't be pickled to spawned workers; each worker makes its own
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def _load_resized(self, path: str) -> np.ndarray:
+        # PIL resize to the processor's size/resample, kept as uint8 HWC; the same
+        # helper packs the memmap, so both input paths yield identical pixels
+        return load_image_resized(path, self.image_size, self.resample)
 
     def __call__(self, batch):
-        images = [load_image_rgb(s.image_path) for s in batch]
-        texts = [s.text for s in batch]
-        inputs = self.processor(images=images, text=texts, return_tensors="pt", padding=True, truncation=True)
+        texts = [t for _, t in batch]
+        if isinstance(batch[0][0], np.ndarray):
+            # pre-resized uint8 NHWC from the memmap
+            images = [im for im, _ in batch]
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.decode_threads)
+            # PIL releases the GIL while decoding, so the batch decodes in parallel
+            images = list(self._pool.map(self._load_resized, [p for p, _ in batch]))
+
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True)
+        # the NCHW view of an NHWC stack is already channels_last
+        inputs["pixel_values"] = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2)
         inputs["labels"] = inputs["input_ids"].clone()
-        return inputs
+        return dict(inputs)
+
+
+class CUDAPrefetcher:
+    """Copies the next batch to the GPU on a side stream while the current one trains."""
+
+    def __init__(self, loader: DataLoader, device: str):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self):
+        self._it = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self) -> None:
+        try:
+            batch = next(self._it)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        # tensors were allocated on the side stream; keep them alive for the compute stream
+        for v in batch.values():
+            v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
 
 
 def collate_fn(processor: BlipProcessor, batch):
-    images = [load_image_rgb(s.image_path) for s in batch]
-    texts = [s.text for s in batch]
+    images = [load_image_rgb(p) for p, _ in batch]
+    texts = [t for _, t in batch]
 
     inputs = processor(images=images, text=texts, return_tensors="pt", padding=True, truncation=True)
     # For BLIP conditional generation, labels are input_ids
@@ -39,13 +110,15 @@ def main():
     parser.add_argument("--val_jsonl", default="data/val.jsonl")
     parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
     parser.add_argument("--out_dir", default="outputs/lora_adapter")
-    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=16)
     parser.add_argument("--grad_accum", type=int, default=4)
     parser.add_argument("--epochs", type=int, default=1)
     parser.add_argument("--lr", type=float, default=2e-4)
     parser.add_argument("--warmup_steps", type=int, default=200)
     parser.add_argument("--max_train_steps", type=int, default=2000)  # для первого прогона ограничим
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--train_memmap", default=None, help="Pre-resized images from src.pack_dataset")
+    parser.add_argument("--num_workers", type=int, default=max(4, (os.cpu_count() or 1) // 2))
     args = parser.parse_args()
 
     torch.manual_seed(args.seed)
@@ -54,9 +127,13 @@ def main():
     if device != "cuda":
         raise RuntimeError("Training should be run on CUDA (your RTX 3070 Ti).")
 
+    # inputs are always 384x384, so let cuDNN pick the fastest conv algorithm once
+    torch.backends.cudnn.benchmark = True
+
     processor = BlipProcessor.from_pretrained(args.model)
-    model = BlipForConditionalGeneration.from_pretrained(args.model, use_safetensors=True)
+    model = load_blip_model(args.model)
     model.to(device)
+    model.vision_model.to(memory_format=torch.channels_last)
 
     # LoRA: target text decoder attention projections
     lora_cfg = LoraConfig(
@@ -67,21 +144,31 @@ def main():
         target_modules=["query", "value"],
     )
     model = get_peft_model(model, lora_cfg)
+    # Recompute activations in backward only in the text decoder, where the LoRA
+    # layers live; the frozen vision tower gets no grads and isn't checkpointed.
+    # Non-reentrant checkpointing propagates grads to LoRA params without
+    # requiring the checkpointed inputs to need grad, so no input hook is needed.
+    model.base_model.model.text_decoder.gradient_checkpointing_enable(
+        gradient_checkpointing_kwargs={"use_reentrant": False}
+    )
     model.print_trainable_parameters()
 
-    train_ds = ProductCaptionDataset(args.train_jsonl)
+    train_ds = ProductCaptionDataset(args.train_jsonl, memmap_path=args.train_memmap)
     collator = BlipCollator(processor)
 
     train_loader = DataLoader(
         train_ds,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=0,
+        batch_sampler=SortedBatchSampler(train_ds, args.batch_size),
+        num_workers=args.num_workers,
         collate_fn=collator,
         pin_memory=True,
+        # workers decode images and run the processor while the GPU trains
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=4 if args.num_workers > 0 else None,
     )
 
-    optim = torch.optim.AdamW(model.parameters(), lr=args.lr)
+    # 8-bit optimizer state, allocated for the trainable LoRA params only
+    optim = bnb.optim.AdamW8bit([p for p in model.parameters() if p.requires_grad], lr=args.lr)
 
     # total steps
     steps_per_epoch = max(1, len(train_loader) // args.grad_accum)
@@ -94,16 +181,22 @@ def main():
     )
 
     model.train()
-    scaler = torch.amp.GradScaler("cuda", enabled=True)
+    # bf16 on Ampere+ has fp32 range, so loss scaling is only needed for the fp16 fallback
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=amp_dtype == torch.float16)
+
+    # BlipCollator yields uint8 pixels; rescale/normalize them here on the GPU
+    pixel_mean = torch.tensor(processor.image_processor.image_mean, device=device).view(1, 3, 1, 1)
+    pixel_std = torch.tensor(processor.image_processor.image_std, device=device).view(1, 3, 1, 1)
 
     step = 0
     optim.zero_grad(set_to_none=True)
 
     for epoch in range(args.epochs):
-        for batch in train_loader:
-            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+        for batch in CUDAPrefetcher(train_loader, device):
+            batch["pixel_values"] = batch["pixel_values"].float().div_(255).sub_(pixel_mean).div_(pixel_std)
 
-            with torch.autocast(device_type="cuda", dtype=torch.float16):
+            with torch.autocast(device_type="cuda", dtype=amp_dtype):
                 out = model(**batch)
                 loss = out.loss / args.grad_accum
 